@@ -152,6 +152,8 @@ async function init() {
     // 3. Connect to WebSocket server using the permanent ID
     // The token is now managed by the browser's cookies
     websocket = new WebSocket(WS_URL);
+    // Relayed signaling frames arrive as binary; decode them before parsing
+    websocket.binaryType = 'arraybuffer';
 
     websocket.onopen = () => {
         console.log('WebSocket connection established.');
@@ -160,7 +162,8 @@ async function init() {
     };
 
     websocket.onmessage = async (event) => {
-        const message = JSON.parse(event.data);
+        const raw = event.data instanceof ArrayBuffer ? new TextDecoder().decode(event.data) : event.data;
+        const message = JSON.parse(raw);
         console.log("Received message:", message);
         
         // Handle different signaling messages